@@ -1,23 +1,43 @@
 #!/usr/bin/env python3
 import os
+import socket
+import struct
 import threading
 import time
-from flask import Flask, Response, send_from_directory, render_template_string
+from flask import Flask, Response, request, send_from_directory, render_template_string
 import cv2
 
+try:
+    import fcntl  # lets us see how much a viewer still has queued
+except ImportError:
+    fcntl = None
+
 # ───── CONFIG ───────────────────────────────────────────────────────────────
 CLIP_DIR = os.path.join(os.path.dirname(__file__), "clips")
 SEGMENT_DURATION = 30  # seconds per clip
 MAX_CLIPS = 10         # keep at most this many
 
+# live view, per viewer
+STREAM_MAX_FPS = 15               # never push more than this to one viewer
+STREAM_MIN_FPS = 1                # below this at the lowest quality, drop the viewer
+JPEG_QUALITIES = (80, 60, 40, 25) # a slow viewer steps down through these
+STALL_TIMEOUT = 5.0               # seconds one frame may take to leave the server
+MIN_SAMPLES = 3                   # frames measured at a quality before stepping down
+MIN_LEVEL_TIME = 2.0              # seconds at a quality before stepping down
+STEP_UP_AFTER = 5.0               # seconds of headroom before raising quality again
+FALLBACK_SEND_BUFFER = 64 * 1024  # pinned only where unsent bytes can't be read
+SIOCOUTQNSD = 0x894B              # Linux ioctl: bytes queued but not yet sent
+
 os.makedirs(CLIP_DIR, exist_ok=True)
 
-# shared latest frame
+# shared latest frame (frame_seq bumps on every new capture, both under frame_lock)
 global_frame = None
+frame_seq = 0
+frame_lock = threading.Lock()
 
 # ───── CAMERA CAPTURE THREAD ─────────────────────────────────────────────────
 def capture_loop():
-    global global_frame
+    global global_frame, frame_seq
     cap = cv2.VideoCapture(0)
     if not cap.isOpened():
         raise RuntimeError("Could not open camera")
@@ -25,7 +45,10 @@ def capture_loop():
         while True:
             ret, frame = cap.read()
             if ret:
-                global_frame = frame.copy()
+                frame = frame.copy()
+                with frame_lock:
+                    global_frame = frame
+                    frame_seq += 1
             else:
                 time.sleep(0.01)
     finally:
@@ -75,26 +98,149 @@ def recorder_loop():
 # ───── FLASK APP ────────────────────────────────────────────────────────────
 app = Flask(__name__)
 
-def gen_mjpeg():
-    """Yield MJPEG frames from the latest camera frame."""
-    global global_frame
+# newest JPEG per quality, so each capture is encoded once however many viewers
+_jpeg_lock = threading.Lock()
+_jpeg_cache = {}  # quality -> (frame_seq, jpeg bytes)
+
+def latest_jpeg(quality):
+    """Return (seq, jpeg) for the newest camera frame at the given quality."""
+    with frame_lock:
+        seq, frame = frame_seq, global_frame
+    if frame is None:
+        return seq, None
+    with _jpeg_lock:
+        cached = _jpeg_cache.get(quality)
+        if cached and cached[0] == seq:
+            return cached
+        _, buf = cv2.imencode('.jpg', frame, [cv2.IMWRITE_JPEG_QUALITY, quality])
+        _jpeg_cache[quality] = (seq, buf.tobytes())
+        return _jpeg_cache[quality]
+
+def unsent_bytes(sock):
+    """Bytes the kernel has queued for sock but not yet sent, or None if we can't tell."""
+    if sock is None or fcntl is None:
+        return None
+    try:
+        out = fcntl.ioctl(sock.fileno(), SIOCOUTQNSD, b'\0' * 4)
+    except (AttributeError, OSError):
+        return None
+    return struct.unpack('i', out)[0]
+
+def drop_viewer(sock, peer, why):
+    print(f"[-] Dropped {why} viewer {peer}", flush=True)
+    if sock is not None:
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+def gen_mjpeg(sock=None, peer=None):
+    """
+    Yield MJPEG frames for one viewer, always skipping to the newest frame.
+
+    After each part we wait until the kernel has put all of it on the wire
+    before picking the next, so a viewer never has more than one frame
+    waiting to go out. Part size over that wait gives the link's throughput,
+    which paces the viewer and, once measured for a while, decides its JPEG
+    quality: down when STREAM_MIN_FPS can't be held, back up after
+    STEP_UP_AFTER seconds with room for the next quality, and a drop once
+    even the lowest quality is too much.
+
+    The not-yet-sent count needs Linux (SIOCOUTQNSD) and the connection
+    socket, which only the Werkzeug server (app.run) exposes. Elsewhere the
+    send buffer is pinned to FALLBACK_SEND_BUFFER so writes block and the
+    yield timing tracks the link, at the cost of a few frames of latency.
+    Stall shedding also needs the socket.
+    """
+    backlog_known = unsent_bytes(sock) is not None
+    if sock is not None:
+        # Werkzeug treats the timeout as a dropped connection and closes us
+        sock.settimeout(STALL_TIMEOUT)
+        if not backlog_known:
+            try:
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, FALLBACK_SEND_BUFFER)
+            except OSError:
+                pass
+
+    level = 0          # index into JPEG_QUALITIES
+    rate = None        # smoothed bytes/s the link takes
+    samples = 0        # frames measured at this level
+    level_since = time.monotonic()
+    up_size = None     # size of a frame at the next higher quality
+    good_since = None  # start of the current stretch with room for up_size
+    last_seq = None
+
+    def change_level(new_level):
+        nonlocal level, samples, level_since, up_size, good_since
+        level, samples, good_since = new_level, 0, None
+        level_since = time.monotonic()
+        up_size = None
+        if level > 0:
+            up_size = len(latest_jpeg(JPEG_QUALITIES[level - 1])[1])
+        print(f"[*] Viewer {peer} quality -> {JPEG_QUALITIES[level]}", flush=True)
+
     while True:
-        if global_frame is None:
+        started = time.monotonic()
+        seq, jpeg = latest_jpeg(JPEG_QUALITIES[level])
+        if jpeg is None or seq == last_seq:
             time.sleep(0.01)
             continue
-        _, buf = cv2.imencode('.jpg', global_frame)
-        frame = buf.tobytes()
-        yield (
+        last_seq = seq
+        part = (
             b'--frame\r\n'
             b'Content-Type: image/jpeg\r\n\r\n' +
-            frame +
+            jpeg +
             b'\r\n'
         )
-        time.sleep(0.01)
+
+        sent = time.monotonic()
+        try:
+            yield part
+        except GeneratorExit:
+            if time.monotonic() - sent >= STALL_TIMEOUT:
+                print(f"[-] Dropped stalled viewer {peer}", flush=True)
+            else:
+                print(f"[-] Viewer {peer} disconnected", flush=True)
+            raise
+
+        # wait for the kernel to put this frame on the wire before the next
+        while (unsent_bytes(sock) or 0) > 0:
+            if time.monotonic() - sent >= STALL_TIMEOUT:
+                drop_viewer(sock, peer, "stalled")
+                return
+            time.sleep(0.005)
+        took = max(time.monotonic() - sent, 0.001)
+        rate = len(part) / took if rate is None else 0.7 * rate + 0.3 * len(part) / took
+        samples += 1
+
+        # frames/s the link can take at this quality, with some headroom
+        now = time.monotonic()
+        fps = rate / (len(part) * 1.25)
+        settled = samples >= MIN_SAMPLES and now - level_since >= MIN_LEVEL_TIME
+        if fps < STREAM_MIN_FPS and settled:
+            if level == len(JPEG_QUALITIES) - 1:
+                drop_viewer(sock, peer, "slow")
+                return
+            change_level(level + 1)
+            continue
+        # step up only with room for twice STREAM_MIN_FPS at the next quality
+        if up_size is not None and rate / (up_size * 1.25) >= 2 * STREAM_MIN_FPS:
+            if good_since is None:
+                good_since = now
+            elif now - good_since >= STEP_UP_AFTER:
+                change_level(level - 1)
+        else:
+            good_since = None
+
+        interval = 1.0 / min(STREAM_MAX_FPS, fps)
+        delay = interval - (now - started)
+        if delay > 0:
+            time.sleep(delay)
 
 @app.route('/video_feed')
 def video_feed():
-    return Response(gen_mjpeg(),
+    return Response(gen_mjpeg(request.environ.get('werkzeug.socket'),
+                              request.remote_addr),
                     mimetype='multipart/x-mixed-replace; boundary=frame')
 
 @app.route('/clips/<path:filename>')
@@ -0,0 +1,400 @@
+"""
+Throttled-viewer harness for the /video_feed MJPEG stream.
+
+Serves the real Flask app with a synthetic frame producer in place of the
+camera, then connects raw sockets with a tiny receive buffer that read at a
+fixed slow rate (plus one that stops reading, and one that reads flat out)
+and checks that:
+
+  * every frame a viewer gets was the newest one when it was sent, so its
+    age stays bounded no matter how slow the viewer is
+  * a slow viewer steps down through JPEG_QUALITIES and is then dropped
+  * a viewer that stops reading is dropped as stalled
+  * a fast viewer on the same server still gets close to STREAM_MAX_FPS
+  * no more than one frame per viewer waits in the kernel to be sent
+
+The loopback run has no RTT to speak of, so a second set of cases drives
+gen_mjpeg() against a simulated link (fake clock plus an `unsent_bytes`
+that drains at a chosen bandwidth after a chosen delay) to check that a
+high-RTT, high-bandwidth viewer is kept at full quality and that a viewer
+whose link recovers is stepped back up.
+"""
+import importlib
+import os
+import socket
+import sys
+import threading
+import time
+import tracemalloc
+
+import pytest
+
+np = pytest.importorskip("numpy")
+cv2 = pytest.importorskip("cv2")
+pytest.importorskip("flask")
+from werkzeug.serving import make_server
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+PRODUCER_FPS = 30
+WIDTH, HEIGHT = 640, 480
+SEQ_BITS = 32             # frame_seq is stamped into the top rows as a barcode
+BAR_W, BAR_H = WIDTH // SEQ_BITS, 16
+RECV_BUFFER = 1024        # kernel rounds this up to its minimum
+MSS = 536                 # a small segment size, as on a poor mobile link
+FAST_SECONDS = 10.0
+
+
+# ───── SYNTHETIC CAMERA ──────────────────────────────────────────────────────
+_y, _x = np.mgrid[0:HEIGHT, 0:WIDTH]
+GRADIENT = np.dstack([
+    (_x * 255 // WIDTH),
+    (_y * 255 // HEIGHT),
+    ((_x + _y) * 255 // (WIDTH + HEIGHT)),
+]).astype(np.uint8)
+
+def make_frame(seq):
+    # built from GRADIENT in uint8 so the producer's own churn stays small
+    frame = GRADIENT.copy()
+    frame[:, :, 2] = np.roll(GRADIENT[:, :, 2], seq * 4, axis=1)
+    for bit in range(SEQ_BITS):
+        value = 255 if (seq >> bit) & 1 else 0
+        frame[:BAR_H, bit * BAR_W:(bit + 1) * BAR_W] = value
+    return frame
+
+def read_seq(jpeg):
+    img = cv2.imdecode(np.frombuffer(jpeg, np.uint8), cv2.IMREAD_GRAYSCALE)
+    seq = 0
+    for bit in range(SEQ_BITS):
+        if img[BAR_H // 2, bit * BAR_W + BAR_W // 2] > 128:
+            seq |= 1 << bit
+    return seq
+
+def read_quality(jpeg, qualities):
+    """Match the first luminance DQT entry against libjpeg's scaling."""
+    at = jpeg.index(b'\xff\xdb')
+    dc = jpeg[at + 5]
+    for q in qualities:
+        scale = 5000 // q if q < 50 else 200 - 2 * q
+        if max(1, (16 * scale + 50) // 100) == dc:
+            return q
+    raise AssertionError(f"unknown JPEG quality (DC quant {dc})")
+
+def producer_loop(mod, produced, stop):
+    while not stop.is_set():
+        seq = mod.frame_seq + 1
+        frame = make_frame(seq)
+        produced[seq] = time.monotonic()
+        with mod.frame_lock:
+            mod.global_frame = frame
+            mod.frame_seq = seq
+        time.sleep(1.0 / PRODUCER_FPS)
+
+
+# ───── VIEWER ────────────────────────────────────────────────────────────────
+class Viewer:
+    """Raw-socket MJPEG client reading at most `rate` bytes/s (None = flat out)."""
+
+    def __init__(self, port, rate=None):
+        self.rate = rate
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, RECV_BUFFER)
+        # loopback's ~64 KB MSS dwarfs the receive buffer, so window updates
+        # would never go out and the server would sit on zero-window probes
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_MAXSEG, MSS)
+        self.sock.connect(("127.0.0.1", port))
+        self.sock.sendall(b"GET /video_feed HTTP/1.1\r\nHost: localhost\r\n\r\n")
+        self.sock.settimeout(0.05)
+        self.rcvbuf = self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF)
+        self.buf = b''
+        self.frames = []  # (received at, jpeg)
+        self.closed = False
+
+    def _parse(self, now):
+        while True:
+            head = self.buf.find(b'Content-Type: image/jpeg\r\n\r\n')
+            if head < 0:
+                return
+            start = head + len(b'Content-Type: image/jpeg\r\n\r\n')
+            end = self.buf.find(b'\xff\xd9', start)
+            if end < 0:
+                return
+            self.frames.append((now, self.buf[start:end + 2]))
+            self.buf = self.buf[end + 2:]
+
+    def read_for(self, seconds):
+        """Read for up to `seconds`; stops early once the server hangs up."""
+        budget, last = 0.0, time.monotonic()
+        deadline = last + seconds
+        while not self.closed and time.monotonic() < deadline:
+            now = time.monotonic()
+            if self.rate is None:
+                want = 65536
+            else:
+                budget = min(budget + (now - last) * self.rate, 4096)
+                want = int(budget)
+            last = now
+            if want < 1:
+                time.sleep(0.01)
+                continue
+            try:
+                data = self.sock.recv(want)
+            except socket.timeout:
+                continue
+            except ConnectionError:
+                data = b''
+            if not data:
+                self.closed = True
+                break
+            budget -= len(data)
+            self.buf += data
+            self._parse(time.monotonic())
+        return self
+
+    def close(self):
+        self.sock.close()
+
+
+# ───── FIXTURES ──────────────────────────────────────────────────────────────
+@pytest.fixture(params=["allinone", "allinonezerotiersupport"])
+def served(request):
+    mod = importlib.import_module(request.param)
+    mod._jpeg_cache.clear()
+    with mod.frame_lock:
+        mod.global_frame, mod.frame_seq = None, 0
+
+    # record the largest backlog any viewer socket reaches
+    backlog = {"max": 0}
+    real_unsent = mod.unsent_bytes
+
+    def watched_unsent(sock):
+        n = real_unsent(sock)
+        if n is not None:
+            backlog["max"] = max(backlog["max"], n)
+        return n
+
+    mod.unsent_bytes = watched_unsent
+    produced, stop = {}, threading.Event()
+    threading.Thread(target=producer_loop, args=(mod, produced, stop), daemon=True).start()
+    server = make_server("127.0.0.1", 0, mod.app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        yield mod, server.server_port, produced, backlog
+    finally:
+        server.shutdown()
+        stop.set()
+        mod.unsent_bytes = real_unsent
+
+
+# ───── TEST ──────────────────────────────────────────────────────────────────
+@pytest.mark.skipif(not sys.platform.startswith("linux"),
+                    reason="backlog checks need SIOCOUTQNSD on sockets")
+def test_throttled_viewers(served, capsys):
+    mod, port, produced, backlog = served
+    qualities = mod.JPEG_QUALITIES
+
+    # a slow link that can't hold STREAM_MIN_FPS even at the lowest quality
+    lowest = len(cv2.imencode('.jpg', make_frame(1),
+                              [cv2.IMWRITE_JPEG_QUALITY, qualities[-1]])[1])
+    highest = len(cv2.imencode('.jpg', make_frame(1),
+                               [cv2.IMWRITE_JPEG_QUALITY, qualities[0]])[1])
+    slow_rate = lowest * mod.STREAM_MIN_FPS / 1.2
+    assert highest / slow_rate < mod.STALL_TIMEOUT, "synthetic frame too big for the harness"
+
+    tracemalloc.start()
+    try:
+        slow = [Viewer(port, slow_rate) for _ in range(2)]
+        stalled = Viewer(port, rate=0)
+        fast = Viewer(port)
+        started = time.monotonic()
+
+        runs = [threading.Thread(target=v.read_for, args=(FAST_SECONDS * 5,)) for v in slow]
+        runs.append(threading.Thread(target=fast.read_for, args=(FAST_SECONDS,)))
+        runs.append(threading.Thread(target=stalled.read_for, args=(mod.STALL_TIMEOUT + 3,)))
+        for t in runs:
+            t.start()
+        time.sleep(2)
+        baseline, _ = tracemalloc.get_traced_memory()
+        for t in runs:
+            t.join()
+        # leave out the frames the viewers here have kept for checking
+        held = sum(len(jpeg) for v in slow + [stalled, fast] for _, jpeg in v.frames)
+        grown = tracemalloc.get_traced_memory()[0] - baseline - held
+    finally:
+        tracemalloc.stop()
+
+    # the stalled viewer's socket now holds whatever was queued; drain it
+    stalled.rate = None
+    stalled.read_for(2)
+    log = capsys.readouterr().out
+
+    # fast viewer keeps near full rate while the others struggle
+    fast_fps = len(fast.frames) / FAST_SECONDS
+    assert fast_fps >= 0.8 * mod.STREAM_MAX_FPS, fast_fps
+
+    for v in slow:
+        assert v.closed, "slow viewer was never dropped"
+        assert len(v.frames) >= len(qualities)
+
+        seen = [read_quality(jpeg, qualities) for _, jpeg in v.frames]
+        assert seen == sorted(seen, reverse=True), seen
+        assert seen[0] == qualities[0] and seen[-1] == qualities[-1], seen
+
+        # each frame was the newest when the previous one finished draining
+        slack = v.rcvbuf / slow_rate + 2.0 / PRODUCER_FPS + 0.2
+        prev_done = started
+        for done, jpeg in v.frames:
+            made = produced[read_seq(jpeg)]
+            assert made >= prev_done - slack, (made - prev_done, slack)
+            assert done - made <= mod.STALL_TIMEOUT + slack
+            prev_done = done
+
+    assert stalled.closed
+    assert "Dropped slow viewer" in log
+    assert "Dropped stalled viewer" in log
+
+    # per-viewer memory stays bounded: at most one frame waiting in the
+    # kernel, and nothing piling up in the process
+    assert backlog["max"] <= 1.5 * highest, backlog["max"]
+    assert grown < 8 * 1024 * 1024, grown
+
+    for v in slow + [stalled, fast]:
+        v.close()
+
+
+# ───── SIMULATED LINKS ───────────────────────────────────────────────────────
+class FakeClock:
+    """Stands in for `time` in the server module and publishes camera frames."""
+
+    def __init__(self, mod):
+        self.mod = mod
+        self.now = 0.0
+        self.next_frame = 0.0
+        self.base = make_frame(0)
+        self._produce()
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += max(seconds, 0.001)
+        self._produce()
+
+    def _produce(self):
+        while self.now >= self.next_frame:
+            seq = self.mod.frame_seq + 1
+            frame = self.base.copy()
+            for bit in range(SEQ_BITS):
+                frame[:BAR_H, bit * BAR_W:(bit + 1) * BAR_W] = 255 if (seq >> bit) & 1 else 0
+            with self.mod.frame_lock:
+                self.mod.global_frame, self.mod.frame_seq = frame, seq
+            self.next_frame += 1.0 / PRODUCER_FPS
+
+
+class FakeLink:
+    """Drains each part at bandwidth(now) bytes/s after delay(frame number) seconds."""
+
+    def __init__(self, clock, bandwidth, delay=lambda n: 0.0):
+        self.clock = clock
+        self.bandwidth = bandwidth
+        self.delay = delay
+        self.frames = 0
+        self.size = 0
+        self.sent_at = 0.0
+
+    def send(self, nbytes):
+        self.frames += 1
+        self.size = nbytes
+        self.sent_at = self.clock.now
+
+    def unsent(self, sock):
+        elapsed = self.clock.now - self.sent_at - self.delay(self.frames)
+        pushed = max(0.0, elapsed) * self.bandwidth(self.clock.now)
+        return max(0, int(self.size - pushed))
+
+
+class FakeSock:
+    def __init__(self):
+        self.options = {}
+
+    def settimeout(self, timeout):
+        pass
+
+    def setsockopt(self, level, name, value):
+        self.options[name] = value
+
+    def shutdown(self, how):
+        pass
+
+
+def simulate(mod, monkeypatch, bandwidth, seconds, delay=lambda n: 0.0):
+    """Run one viewer over a simulated link; returns [(time, quality)], dropped."""
+    mod._jpeg_cache.clear()
+    with mod.frame_lock:
+        mod.global_frame, mod.frame_seq = None, 0
+    clock = FakeClock(mod)
+    link = FakeLink(clock, bandwidth, delay)
+    monkeypatch.setattr(mod, "time", clock)
+    monkeypatch.setattr(mod, "unsent_bytes", link.unsent)
+
+    sent, dropped = [], False
+    gen = mod.gen_mjpeg(FakeSock(), "sim")
+    while clock.now < seconds:
+        try:
+            part = next(gen)
+        except StopIteration:
+            dropped = True
+            break
+        link.send(len(part))
+        sent.append((clock.now, read_quality(part, mod.JPEG_QUALITIES)))
+    gen.close()
+    return sent, dropped
+
+
+def frame_size(mod, quality):
+    return len(cv2.imencode('.jpg', FakeClock(mod).base,
+                            [cv2.IMWRITE_JPEG_QUALITY, quality])[1])
+
+
+@pytest.mark.parametrize("name", ["allinone", "allinonezerotiersupport"])
+def test_high_rtt_viewer_keeps_full_quality(name, monkeypatch, capsys):
+    mod = importlib.import_module(name)
+    # 10 MB/s with a 300 ms RTT: a 2.5 s glitch on the first frame, then a
+    # round trip per frame while slow start opens the window
+    sent, dropped = simulate(mod, monkeypatch, bandwidth=lambda t: 10e6, seconds=20,
+                             delay=lambda n: 2.5 if n == 1 else 0.3 if n <= 5 else 0.0)
+    assert not dropped
+    assert {q for _, q in sent} == {mod.JPEG_QUALITIES[0]}
+    assert len(sent) >= 0.8 * mod.STREAM_MAX_FPS * (20 - 2.5)
+
+
+@pytest.mark.parametrize("name", ["allinone", "allinonezerotiersupport"])
+def test_recovered_viewer_steps_back_up(name, monkeypatch, capsys):
+    mod = importlib.import_module(name)
+    qualities = mod.JPEG_QUALITIES
+    # slow enough to leave the top quality but fine at the lowest one
+    poor = frame_size(mod, qualities[-1]) * mod.STREAM_MIN_FPS * 2
+    assert frame_size(mod, qualities[0]) * 1.25 * mod.STREAM_MIN_FPS > poor
+
+    # each frame also waits 50 ms to drain, as on a link with real RTT
+    recover_at = 15.0
+    sent, dropped = simulate(mod, monkeypatch, seconds=recover_at + 30,
+                             bandwidth=lambda t: poor if t < recover_at else 10e6,
+                             delay=lambda n: 0.05)
+    assert not dropped
+    before = [q for t, q in sent if t < recover_at]
+    assert min(before) < qualities[0], before
+    assert sent[-1][1] == qualities[0]
+
+
+@pytest.mark.parametrize("name", ["allinone", "allinonezerotiersupport"])
+def test_fallback_pins_send_buffer(name, monkeypatch):
+    mod = importlib.import_module(name)
+    monkeypatch.setattr(mod, "unsent_bytes", lambda sock: None)
+    sock = FakeSock()
+    gen = mod.gen_mjpeg(sock, "sim")
+    with mod.frame_lock:
+        mod.global_frame, mod.frame_seq = make_frame(1), 1
+    next(gen)
+    gen.close()
+    assert sock.options[socket.SO_SNDBUF] == mod.FALLBACK_SEND_BUFFER